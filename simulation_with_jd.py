@@ -6,13 +6,20 @@ April 15, 2024
 """
 
 # Import needed modules
+import hashlib
+import os
+from pathlib import Path
 import pandas as pd
 import numpy as np
+import numexpr as ne
 import matplotlib.pyplot as plt
 import seaborn as sns
 import scipy.stats as stats
-from scipy.stats import probplot, skew, kurtosis
+from scipy.stats import skew, kurtosis
+from scipy.special import ndtri
 import yfinance as yf
+from numba import njit, prange
+from joblib import Parallel, delayed
 
 sns.set_theme()
 
@@ -24,13 +31,60 @@ end_date = '2024-03-31'
 # Create a list with the tickers to use.
 tickers = ['SPY', 'IWM', 'GOVT', 'LQD', 'EFA', 'EEM', 'IGOV', 'IBND']
 
+# version of the cached price files; bump it whenever the cached contents change
+# (2: daily prices are no longer dropna()'d before caching)
+_PRICE_CACHE_FORMAT = 2
+
+
+# create a function to download the prices once and reuse them on later runs
+def _load_prices(tickers, start, end, cache_dir='.cache'):
+    """
+    Loads adjusted close prices from Yahoo Finance, caching the result on disk as parquet.
+
+    Parameters:
+    tickers (list): Tickers to download.
+    start (str): Start date of the price history.
+    end (str): End date of the price history.
+    cache_dir (str): Directory holding the cached parquet files. Defaults to '.cache'.
+
+    Returns:
+    pd.DataFrame: Adjusted close prices, one column per ticker.
+
+    Raises:
+    RuntimeError: If the download is empty or any ticker came back without prices.
+    """
+    # hashlib gives a key that is stable across runs, unlike the built-in hash(). The format tag
+    # is part of the key, so files written before a change to what gets cached are never read back.
+    key = hashlib.md5(repr((_PRICE_CACHE_FORMAT, tuple(tickers), start, end)).encode()).hexdigest()
+    path = Path(cache_dir) / f'{key}.parquet'
+    if path.exists():
+        return pd.read_parquet(path)
+
+    df = yf.download(tickers, start, end)['Adj Close']
+
+    # yf.download doesn't raise when a ticker fails, it returns an all-NaN column instead.
+    # Never cache a failed or partial download, or every later run would reuse it.
+    if df.empty or df.isna().all().any():
+        failed = list(df.columns[df.isna().all()]) if not df.empty else list(tickers)
+        raise RuntimeError(f"Download from Yahoo Finance failed for {failed}; nothing was cached.")
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    df.to_parquet(path)
+    return df
+
+
 # retrieve the prices from yahoo finance
-df_prices = yf.download(tickers, start_date, end_date)['Adj Close'].dropna()
+df_prices = _load_prices(tickers, start_date, end_date)
 print(df_prices.head())
 
 # resample to monthly, and convert to returns
-df_prices.index = pd.to_datetime(df_prices.index)
-df_returns = df_prices.resample('M').last().pct_change().dropna()
+# keep the last trading day of each month, using the last valid price of each ticker (like
+# resample().last()) so a missing quote on a month-end row doesn't blank out that month.
+# Months before the youngest ticker's inception have no price and are dropped.
+is_month_end = np.r_[np.diff(df_prices.index.month.values) != 0, True]
+monthly_prices = df_prices.ffill().values[is_month_end]
+df_returns = pd.DataFrame(monthly_prices[1:] / monthly_prices[:-1] - 1.0,
+                          index=df_prices.index[is_month_end][1:], columns=df_prices.columns).dropna()
 print(df_returns.head())
 
 # create a function that will show the histogram of monthly returns for all
@@ -46,42 +100,29 @@ def plot_return_histograms(returns, stacked=False, bars=True):
     bars (bool): If True, shows histogram bars along with the smooth KDE.
                  If False, shows only the smooth KDE without bars.
     """
-    n_assets = returns.shape[1]  # Number of asset classes
-    asset_names = returns.columns  # Asset class names
+    # Reshape to long format so seaborn handles every asset class in one call
+    long_returns = returns.melt(var_name='Asset', value_name='Return')
 
     if stacked:
         plt.figure(figsize=(12, 8))
-        for asset_name in asset_names:
-            if bars:
-                sns.histplot(returns[asset_name], kde=True, stat="density", element="step", alpha=0.5, bins=30, label=asset_name)
-            else:
-                sns.kdeplot(returns[asset_name], bw_adjust=2, label=asset_name)
-        plt.legend()
+        if bars:
+            sns.histplot(long_returns, x='Return', hue='Asset', kde=True, stat="density", element="step",
+                         alpha=0.5, bins=30, common_bins=False, common_norm=False)
+        else:
+            sns.kdeplot(long_returns, x='Return', hue='Asset', bw_adjust=2, common_norm=False)
         plt.title('Overlapped Histograms of Monthly Returns')
         plt.xlabel('Returns')
         plt.ylabel('Frequency')
     else:
-        # Determine the grid size
-        n_rows = int(np.ceil(n_assets / 4))
-        n_cols = min(n_assets, 4)
-
-        fig, axs = plt.subplots(n_rows, n_cols, figsize=(4 * n_cols, 4 * n_rows), squeeze=False)
-        for i, asset_name in enumerate(asset_names):
-            row, col = divmod(i, n_cols)
-            ax = axs[row, col]
-            if bars:
-                sns.histplot(returns[asset_name], kde=True, stat="density", element="step", alpha=0.5, bins=30, ax=ax)
-            else:
-                sns.kdeplot(returns[asset_name], bw_adjust=2, ax=ax)
-            ax.set_title(asset_name)
-            ax.set_xlabel('Returns')
-            ax.set_ylabel('Frequency')
-
-        # Hide empty subplots
-        for j in range(i+1, n_rows * n_cols):
-            axs.flatten()[j].axis('off')
-
-        plt.tight_layout()
+        # One facet per asset class, wrapped into rows of 4 (empty facets are not drawn)
+        g = sns.FacetGrid(long_returns, col='Asset', col_wrap=4, height=4, sharex=False, sharey=False)
+        if bars:
+            g.map_dataframe(sns.histplot, x='Return', kde=True, stat="density", element="step", alpha=0.5, bins=30)
+        else:
+            g.map_dataframe(sns.kdeplot, x='Return', bw_adjust=2)
+        g.set_titles('{col_name}')
+        g.set_axis_labels('Returns', 'Frequency')
+        g.tight_layout()
 
     plt.show()
 
@@ -110,12 +151,14 @@ def plot_kde_left_tails(returns, x_max=-0.1, y_max=None):
 
     The function creates a plot for each asset class's returns, overlaying their KDEs to focus on
     negative returns up to the `x_max` value. This is useful for visualizing the density and frequency
-    of negative returns in different asset classes.
+    of negative returns in different asset classes. Each KDE is estimated on the full series, but only
+    evaluated up to `x_max`.
     """
     plt.figure(figsize=(10, 6))
 
     for column in returns.columns:
-        sns.kdeplot(returns[column], label=column)
+        # Estimate on the full series, but stop the evaluation grid at x_max
+        sns.kdeplot(returns[column], label=column, clip=(None, x_max))
 
     plt.xlabel('Return')
     plt.ylabel('Density')
@@ -160,8 +203,24 @@ def plot_qq_grid(returns):
     fig, axes = plt.subplots(num_rows, 4, figsize=(4 * 4, num_rows * 4))  # Assume each subplot is 4x4 inches
     axes = axes.flatten()  # Flatten the 2D array of axes to simplify the iteration
 
+    # The theoretical normal quantiles (Blom plotting positions) depend only on the sample size,
+    # so compute them once per length rather than once per asset
+    quantiles = {}
+
     for i, asset in enumerate(returns.columns):
-        probplot(returns[asset].dropna(), dist="norm", plot=axes[i])
+        ordered = np.sort(returns[asset].dropna().values)
+        n = len(ordered)
+        if n not in quantiles:
+            quantiles[n] = ndtri((np.arange(1, n + 1) - 0.375) / (n + 0.25))  # standard normal ppf
+        theoretical = quantiles[n]
+
+        # Least-squares reference line through the points, as probplot draws
+        slope, intercept = np.polyfit(theoretical, ordered, 1)
+
+        axes[i].plot(theoretical, ordered, 'bo')
+        axes[i].plot(theoretical, slope * theoretical + intercept, 'r-')
+        axes[i].set_xlabel('Theoretical quantiles')
+        axes[i].set_ylabel('Ordered Values')
         axes[i].set_title(asset)
 
     # Hide any unused axes if the number of plots is not a multiple of 4
@@ -174,19 +233,64 @@ def plot_qq_grid(returns):
 
 plot_qq_grid(df_returns)
 
+# fitted Johnson SU parameters (gamma, delta, xi, lambda_), keyed by asset and a hash of
+# the returns they were fitted on, so repeated simulations don't refit the same data
+_JSU_PARAMS = {}
+
+
+def _jsu_cache_key(asset, ac_returns):
+    """
+    Builds the _JSU_PARAMS key for an asset class's returns.
+
+    Parameters:
+    asset (str): Name of the asset class.
+    ac_returns (pd.Series, pd.DataFrame or np.ndarray): Returns for the asset class.
+
+    Returns:
+    tuple: The asset name and an md5 digest of the returns.
+    """
+    values = np.ravel(ac_returns).astype(np.float64)
+    return asset, hashlib.md5(values.tobytes()).hexdigest()
+
+
+# create a function to fit the Johnson SU distribution from a sensible starting point
+def _fit_johnsonsu(ac_returns):
+    """
+    Fits a Johnson SU distribution to a series of returns using method-of-moments starting values.
+
+    This only changes the optimizer's starting point: the MLE starts at gamma=0, delta=1 with loc
+    and scale matched to the sample mean and standard deviation, instead of scipy's default start.
+
+    Parameters:
+    ac_returns (pd.Series, pd.DataFrame or np.ndarray): Returns for a single asset class.
+
+    Returns:
+    tuple: The fitted (gamma, delta, xi, lambda_) parameters.
+    """
+    values = np.ravel(ac_returns).astype(np.float64)
+    m, s = values.mean(), values.std(ddof=1)
+
+    # With gamma=0 and delta=1 the standard deviation of sinh(Z) is sqrt((e^2 - 1) / 2)
+    scale0 = s / np.sqrt((np.exp(2.0) - 1.0) / 2.0)
+
+    return stats.johnsonsu.fit(values, 0.0, 1.0, loc=m, scale=scale0)
+
+
 # isolate returns for an asset class
 ac_returns = df_returns[['SPY']]
 
-# Set the seed for reproducibility
-np.random.seed(42)
+# Create a seeded random number generator for reproducibility
+rng = np.random.default_rng(42)
 
-# Fit a Johnson SU distribution to the data
-gamma, delta, xi, lambda_ = stats.johnsonsu.fit(ac_returns)
+# Fit a Johnson SU distribution to the data (cached for the simulations below)
+spy_key = _jsu_cache_key('SPY', ac_returns)
+_JSU_PARAMS[spy_key] = _fit_johnsonsu(ac_returns)
+gamma, delta, xi, lambda_ = _JSU_PARAMS[spy_key]
 
 # Sample from the Johnson SU distribution
 num_samples = len(df_returns)
 sampled_returns = stats.johnsonsu.rvs(gamma, delta, loc=xi, scale=lambda_,
-                                      size=num_samples)
+                                      size=num_samples, random_state=rng)
 
 # Plotting for comparison
 plt.figure(figsize=(10, 6))
@@ -198,7 +302,27 @@ plt.show()
 
 # we need to write a function to calculate the annualized return for a
 # given series of returns
-def annualize_returns(returns, frequency='M'):
+def _periods_per_year(frequency):
+    """
+    Returns the number of return periods per year for a frequency code.
+
+    Parameters:
+    frequency (str): 'M' for monthly, 'D' for daily, 'Q' for quarterly.
+
+    Returns:
+    int: The number of periods per year (12, 252 or 4).
+    """
+    if frequency == 'M':
+        return 12
+    elif frequency == 'D':
+        return 252
+    elif frequency == 'Q':
+        return 4
+    else:
+        raise ValueError("Unsupported frequency. Please use 'M', 'D', or 'Q'.")
+
+
+def annualize_returns(returns, frequency='M', axis=0):
     """
     Annualizes a set of returns given a specific frequency.
 
@@ -208,33 +332,100 @@ def annualize_returns(returns, frequency='M'):
     correctly scaling the returns to an annual basis.
 
     Parameters:
-    returns (pd.Series or pd.DataFrame): A pandas Series or DataFrame containing the returns to be annualized.
+    returns (pd.Series, pd.DataFrame or np.ndarray): The returns to be annualized, one column per series.
     frequency (str): The frequency of the returns. Options: 'M' for monthly, 'D' for daily, 'Q' for quarterly.
                      Defaults to 'M'.
+    axis (int): The axis running over time for np.ndarray input, e.g. 1 for an array with one simulated
+                path per row. pandas input is always annualized down its rows. Defaults to 0.
 
     Returns:
     pd.DataFrame: A DataFrame containing the annualized returns, expressed as percentages and rounded to two decimal places.
+                  For np.ndarray input, an array of the same values is returned instead.
     """
 
     # Determine the number of periods per year based on the frequency
-    if frequency == 'M':
-        periods_per_year = 12
-    elif frequency == 'D':
-        periods_per_year = 252
-    elif frequency == 'Q':
-        periods_per_year = 4
-    else:
-        raise ValueError("Unsupported frequency. Please use 'M', 'D', or 'Q'.")
+    periods_per_year = _periods_per_year(frequency)
 
-    # Calculate compounded growth and number of periods
-    compounded_growth = (returns + 1).prod()
-    n_periods = returns.shape[0]
+    # Calculate compounded growth as a sum of log returns (stable over long series) and number of periods.
+    # nansum skips missing values the same way pandas' prod() did.
+    if hasattr(returns, 'values'):
+        values, axis = returns.values, 0
+    else:
+        values = np.asarray(returns)
+    n_periods = values.shape[axis]
+    log_growth = np.nansum(np.log1p(values), axis=axis)
 
     # Annualize the returns
-    annualized_returns = compounded_growth ** (periods_per_year / n_periods) - 1
+    annualized_returns = np.expm1(log_growth * (periods_per_year / n_periods))
+
+    # Return the annualized returns as a DataFrame (or as an array for array input)
+    if isinstance(returns, pd.DataFrame):
+        return np.round(pd.DataFrame({'Return': annualized_returns * 100}, index=returns.columns), 2)
+    if isinstance(returns, pd.Series):
+        return np.round(pd.DataFrame({'Return': [annualized_returns * 100]}, index=[returns.name]), 2)
+    return np.round(annualized_returns * 100, 2)
+
+
+# compiled kernel to annualize every simulation and average the results.
+# cache=True only helps later runs: on a cold run every joblib worker still compiles it.
+# Inside the simulation workers joblib caps Numba's (and numexpr's) threads to
+# cpu_count // n_jobs, which is why the pool is sized to the number of asset classes.
+@njit(parallel=True, fastmath=True, cache=True)
+def _mean_ann_return(samples, periods_per_year):
+    """
+    Computes the mean annualized return across simulations in a single pass.
 
-    # Return the annualized returns as a DataFrame
-    return np.round(annualized_returns.to_frame(name='Return').mul(100), 2)
+    Parameters:
+    samples (np.ndarray): 2D float32 or float64 array of simulated periodic returns, one row per simulation.
+    periods_per_year (float): Number of return periods per year (e.g., 12 for monthly).
+
+    Returns:
+    float: The average annualized return across all simulations, as a decimal.
+    """
+    n_sims, n = samples.shape
+
+    # Store each simulation's annualized return in a preallocated array, then average it
+    annualized = np.empty(n_sims)
+    for i in prange(n_sims):
+        # Compound through a sum of log returns, accumulated in float64 whatever the sample precision
+        log_growth = 0.0
+        for j in range(n):
+            log_growth += np.log1p(np.float64(samples[i, j]))
+        annualized[i] = np.expm1(log_growth * (periods_per_year / n))
+    return annualized.mean()
+
+
+# function to simulate a single asset class; runs in a worker process, so it
+# only receives the fitted parameters and its own random number generator
+def _simulate_one_asset(params, num_simulations, num_years, periods_per_year, rng):
+    """
+    Simulates returns for one asset class from its fitted Johnson SU parameters.
+
+    Parameters:
+    params (tuple): The fitted (gamma, delta, xi, lambda_) parameters.
+    num_simulations (int): Number of simulations to run.
+    num_years (int): Number of years to simulate for each simulation.
+    periods_per_year (int): Number of return periods per year (e.g., 12 for monthly).
+    rng (np.random.Generator): This asset's random number generator.
+
+    Returns:
+    float: The average annualized return across all simulations, as a decimal.
+    """
+    gamma, delta, xi, lambda_ = params
+
+    # Sample all simulations at once: one row per simulation, one column per period.
+    # Johnson SU draws are a transform of standard normals: xi + lambda * sinh((Z - gamma) / delta)
+    # float32 is plenty for returns reported to 2 decimals and halves the memory traffic;
+    # the parameters are cast too so numexpr keeps the whole expression in float32.
+    sampled_returns = np.empty((num_simulations, num_years * periods_per_year), dtype=np.float32)
+    rng.standard_normal(dtype=np.float32, out=sampled_returns)
+    ne.evaluate('xi + lambda_ * sinh((z - gamma) / delta)',
+                local_dict={'z': sampled_returns, 'xi': np.float32(xi), 'lambda_': np.float32(lambda_),
+                            'gamma': np.float32(gamma), 'delta': np.float32(delta)},
+                out=sampled_returns)
+
+    # Average of the annualized simulations
+    return _mean_ann_return(sampled_returns, float(periods_per_year))
 
 
 # function to run the asset class simulations
@@ -242,51 +433,54 @@ def simulate_asset_class_returns_jsu(returns, num_simulations, num_years, freque
     """
     Simulate future returns for asset classes using Johnson SU distribution and compute expected returns.
 
+    The asset classes are simulated in parallel, each with its own random stream derived from
+    `random_seed`, so results are reproducible regardless of how the work is scheduled.
+
     Args:
-    returns (pd.DataFrame): DataFrame containing historical monthly returns for multiple asset classes.
+    returns (pd.DataFrame): DataFrame containing historical returns for multiple asset classes.
     num_simulations (int): Number of simulations to run for each asset class.
     num_years (int): Number of years to simulate for each simulation.
-    frequency (str): Frequency of returns, 'M' for monthly.
+    frequency (str): Frequency of returns, sets the periods simulated per year: 'M' for monthly,
+                     'D' for daily, 'Q' for quarterly. Defaults to 'M'.
     random_seed (int, optional): Seed for the random number generator to ensure reproducibility.
 
     Returns:
     pd.DataFrame: DataFrame with a single column 'Expected Return', indexed by asset classes.
     """
 
-    # Set the random seed for reproducibility
-    if random_seed is not None:
-        np.random.seed(random_seed)
-
-    # Initialize a DataFrame to store expected returns
-    expected_returns = pd.DataFrame(index=returns.columns, columns=['Expected Return'])
-
-    # Loop through each asset class
-    for asset in returns.columns:
-        # Isolate returns for the current asset class
-        ac_returns = returns[asset].dropna()
-
-        # Fit a Johnson SU distribution to the data
-        gamma, delta, xi, lambda_ = stats.johnsonsu.fit(ac_returns)
-
-        # Initialize a list to store average annualized returns for each simulation
-        avg_annualized_returns = []
-
-        # Run simulations
-        for _ in range(num_simulations):
-            # Sample from the Johnson SU distribution for the entire simulation period
-            sampled_returns = stats.johnsonsu.rvs(gamma, delta, loc=xi, scale=lambda_, size=num_years * 12)
-
-            # Convert sampled returns to a DataFrame
-            sampled_df = pd.DataFrame(sampled_returns, columns=['Returns'])
-
-            # Calculate the average annualized return for this simulation using the DataFrame
-            avg_annualized_return = annualize_returns(sampled_df, frequency=frequency)
-
-            # Store the result
-            avg_annualized_returns.append(avg_annualized_return)
-
-        # Calculate the expected return for this asset class (average of averages)
-        expected_returns.loc[asset, 'Expected Return'] = np.mean(avg_annualized_returns).round(2)
+    # Number of periods per year to simulate and annualize over (raises for unsupported frequencies)
+    periods_per_year = _periods_per_year(frequency)
+
+    # Initialize a float DataFrame to store expected returns (object dtype would box every value)
+    expected_returns = pd.DataFrame(np.full(len(returns.columns), np.nan), index=returns.columns,
+                                    columns=['Expected Return'], dtype=np.float64)
+
+    # Fit a Johnson SU distribution to each asset class whose returns weren't fitted before, in parallel
+    # (one worker per fit; joblib rejects n_jobs=0 when everything is cached)
+    ac_returns = {asset: returns[asset].dropna().values for asset in returns.columns}
+    keys = {asset: _jsu_cache_key(asset, ac_returns[asset]) for asset in returns.columns}
+    to_fit = [asset for asset in returns.columns if keys[asset] not in _JSU_PARAMS]
+    n_jobs = max(1, min(len(to_fit), os.cpu_count() or 1))
+    fitted = Parallel(n_jobs=n_jobs)(delayed(_fit_johnsonsu)(ac_returns[asset]) for asset in to_fit)
+    _JSU_PARAMS.update(zip((keys[asset] for asset in to_fit), fitted))
+    params = {asset: _JSU_PARAMS[keys[asset]] for asset in returns.columns}
+
+    # Give every asset class an independent generator spawned from one seed sequence
+    # (reproducible for a given random_seed, and safe to use across workers)
+    child_seeds = np.random.SeedSequence(random_seed).spawn(returns.shape[1])
+    rngs = [np.random.default_rng(s) for s in child_seeds]
+
+    # Run the simulations for all asset classes in parallel, one worker per asset class, so each
+    # worker keeps cpu_count // n_assets threads for numexpr and the compiled kernel
+    n_jobs = min(returns.shape[1], os.cpu_count() or 1)
+    results = Parallel(n_jobs=n_jobs)(
+        delayed(_simulate_one_asset)(params[asset], num_simulations, num_years, periods_per_year, asset_rng)
+        for asset, asset_rng in zip(returns.columns, rngs)
+    )
+
+    # Calculate the expected return for each asset class (average of the annualized simulations)
+    for asset, mean_annualized in zip(returns.columns, results):
+        expected_returns.loc[asset, 'Expected Return'] = np.round(mean_annualized * 100, 2)
 
     return expected_returns
 